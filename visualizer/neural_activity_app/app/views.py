@@ -1,53 +1,101 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+from collections import OrderedDict
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from rest_framework.views import APIView
 from neo.io import get_io
 from rest_framework.response import Response
 from rest_framework import status
-import urllib
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import urllib2
 from django.views.decorators.clickjacking import xframe_options_exempt
 
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# Parsed neo blocks are expensive to read, and every view re-reads the same
+# file. Keep a small bounded cache of parsed blocks, keyed by (path, mtime)
+# so a re-downloaded file invalidates its stale entry, and evict the least
+# recently used block once the cache is full.
+BLOCK_CACHE_MAX = 8
+_block_cache = OrderedDict()
+_block_cache_lock = threading.Lock()
+
+
+def get_block(na_file):
+    key = (na_file, os.path.getmtime(na_file))
+    with _block_cache_lock:
+        try:
+            # re-insert to mark the entry as most recently used
+            block = _block_cache.pop(key)
+            _block_cache[key] = block
+            return block
+        except KeyError:
+            pass
+    # parse outside the lock so a slow read does not block requests that
+    # hit the cache; two threads racing on the same file just parse twice
+    block = get_io(na_file).read_block()
+    with _block_cache_lock:
+        if key not in _block_cache:
+            if len(_block_cache) >= BLOCK_CACHE_MAX:
+                _block_cache.popitem(last=False)
+            _block_cache[key] = block
+    return block
+
+
+def neo_metadata(obj):
+    # metadata fields shared by neo blocks and segments
+    return {
+        'name': obj.name or "",
+        'description': obj.description or "",
+        'file_origin': obj.file_origin or "",
+        'annotations': obj.annotations,
+    }
+
 
 class Block(APIView):
-   
+
     def get(self, request, format=None, **kwargs):
         na_file = request.session['na_file']
         try:
-            block = get_io(na_file).read_block()
-        except IOError:
+            block = get_block(na_file)
+        except (IOError, OSError):
+            # OSError covers get_block failing to stat a missing session file.
+            # A downloaded file that cannot be parsed is useless; drop it so
+            # the next visit fetches it again instead of reusing it forever
+            if na_file.startswith('neo_file_') and os.path.exists(na_file):
+                os.remove(na_file)
             return Response({'error': 'incorrect file type'}, status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
         # read neo file from hd
-        block_data = {'block': [{
-            'annotations': block.annotations,
-            # 'channel_indexes': block.channel_indexes,
-            'description': block.description or "",
-            # 'file_datetime': block.file_datetime,
-            'file_origin': block.file_origin or "",
-            # 'index': block.index,
-            'name': block.name or "",
-            'rec_datetime': block.rec_datetime,
-            'segments': [
-                {
-                    'name': s.name or "",
-                    'annotations': s.annotations,
-                    'description': s.description or "",
-                    # 'epochs': s.epochs,
-                    # 'events': s.events,
-                    # 'spiketrains': s.spiketrains,
-                    # 'spiketrains': [],
-                    'rec_datetime': s.rec_datetime,
-                    # 'irregularlysampledsignals': s.irregularlysampledsignals,
-                    # 'index': s.index,
-                    'file_origin': s.file_origin or "",
-                    # 'block': s.block,
-                    # 'analogsignals': s.analogsignals,
-                    'analogsignals': [],
-                }
+        block_data = {'block': [dict(
+            neo_metadata(block),
+            # channel_indexes=block.channel_indexes,
+            # file_datetime=block.file_datetime,
+            # index=block.index,
+            rec_datetime=block.rec_datetime,
+            segments=[
+                dict(
+                    neo_metadata(s),
+                    # epochs=s.epochs,
+                    # events=s.events,
+                    # spiketrains=s.spiketrains,
+                    rec_datetime=s.rec_datetime,
+                    # irregularlysampledsignals=s.irregularlysampledsignals,
+                    # index=s.index,
+                    # block=s.block,
+                    analogsignals=[],
+                )
                 for s in block.segments],
-            }]}
+            )]}
 
         return JsonResponse(block_data)
 
@@ -56,27 +104,16 @@ class Segment(APIView):
    
     def get(self, request, format=None, **kwargs):
         na_file = request.session['na_file']
-        block = get_io(na_file).read_block()
+        block = get_block(na_file)
         id_segment = int(request.GET['segment_id'])
         segment = block.segments[id_segment]
 
-        seg_data_test = {
-                    'name': "segment 1",
-                    'description': "a first fake segment",
-                    'file_origin': "nowhere",
-                    'spiketrains': [{}, {}],
-                    'analogsignals': [{}, {}, {}]
-                    }
-
-        seg_data = {
-                    'name': segment.name or "",
-                    'description': segment.description or "",
-                    'file_origin': segment.file_origin or "",
-                    'annotations': segment.annotations,
-                    # 'spiketrains': segment.spiketrains,
-                    'analogsignals': [{} for a in segment.analogsignals],
-                    'as_prop': [{'size': e.size, 'name': e.name.decode('cp1252')} for e in segment.analogsignals]
-                    }
+        seg_data = dict(
+                    neo_metadata(segment),
+                    # spiketrains=segment.spiketrains,
+                    analogsignals=[{} for a in segment.analogsignals],
+                    as_prop=[{'size': e.size, 'name': e.name.decode('cp1252')} for e in segment.analogsignals]
+                    )
       
         return JsonResponse(seg_data, safe=False)
 
@@ -85,23 +122,23 @@ class AnalogSignal(APIView):
    
     def get(self, request, format=None, **kwargs):
         na_file = request.session['na_file']
-        block = get_io(na_file).read_block()
-        id_segment = int(request.GET['segment_id'])
-        id_analog_signal = int(request.GET['analog_signal_id'])
+        block = get_block(na_file)
+        params = request.GET
+        id_segment = int(params['segment_id'])
+        id_analog_signal = int(params['analog_signal_id'])
         segment = block.segments[id_segment]
         analogsignal = segment.analogsignals[id_analog_signal]
   
-        analog_signal_values = []
-        for item in analogsignal:
-            try:  # TODO find a better solution
-                analog_signal_values.append(item.item())
-            except ValueError:
-                analog_signal_values.append(item[1].item())
-
-        analog_signal_times = []
-        for item in analogsignal.times:
-            analog_signal_times.append(item.item())
-    
+        # decide single- vs multi-channel once for the whole signal, then
+        # bulk-convert through the underlying numpy array instead of
+        # building an intermediate Quantity scalar per sample
+        values = analogsignal.magnitude
+        if values.ndim > 1:
+            values = values[:, 1] if values.shape[-1] > 1 else values[:, 0]
+        analog_signal_values = values.tolist()
+
+        analog_signal_times = analogsignal.times.magnitude.tolist()
+
         graph_data = {"values": analog_signal_values,
                       "values_units": str(analogsignal.units.dimensionality),
                       "times": analog_signal_times,
@@ -110,6 +147,10 @@ class AnalogSignal(APIView):
                       "t_stop": analogsignal.t_stop.item()
                       }
 
+        # signal payloads are long lists of floats; ujson serializes them
+        # much faster than the default encoder when it is installed
+        if ujson is not None:
+            return HttpResponse(ujson.dumps(graph_data), content_type='application/json')
         return JsonResponse(graph_data)
 
 
@@ -123,8 +164,26 @@ def home(request):
     if url:
         # get url of neo file
         url = url.rsplit('.', 1)[0] + '.h5'  # TODO update for other file extensions
-        filename = 'neo_file.h5'
-        urllib.urlretrieve(url, filename)
+        # one local file per source url, so a file already downloaded for a
+        # previous visit is reused instead of fetched again
+        filename = 'neo_file_%s.h5' % hashlib.md5(url.encode('utf-8')).hexdigest()
+        if not os.path.exists(filename):
+            # fetch via urllib2 so HTTP errors raise instead of saving the
+            # error page body (urlretrieve would cache a 404 page forever),
+            # write to a unique temporary name so concurrent first visits
+            # cannot interleave into one file, and only rename a complete
+            # download into place
+            response = urllib2.urlopen(url)
+            fd, tmp_filename = tempfile.mkstemp(suffix='.h5', dir='.')
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    shutil.copyfileobj(response, tmp_file)
+            except Exception:
+                os.remove(tmp_filename)
+                raise
+            finally:
+                response.close()
+            os.rename(tmp_filename, filename)
         request.session['na_file'] = filename
     else:
         request.session['na_file'] = 'File_AlphaOmega_1.map'